@@ -1,8 +1,9 @@
 #! /bin/bash
 #SBATCH -n 1
+#SBATCH --cpus-per-task=4
 #SBATCH -t 04:00:00
 #SBATCH --mem-per-cpu=2500M
 #SBATCH --array=0-63
 
 #SBATCH
-srun python all_to_all_stats.py $SLURM_ARRAY_TASK_ID 64
+srun python all_to_all_stats.py $SLURM_ARRAY_TASK_ID 64 $SLURM_CPUS_PER_TASK
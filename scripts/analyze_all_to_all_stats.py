@@ -26,9 +26,11 @@ See the main block (at the end) for an entry point to this script.
 
 
 def _get_raw_stats_filenames():
+    # both the sharded files (all_to_all_stats_targets_<first>_<last>.pkl)
+    # and the older one-file-per-target format (all_to_all_stats_target_<target>.pkl)
     filenames = [os.path.join(ALL_TO_ALL_STATS_DIR, fname)
                  for fname in os.listdir(ALL_TO_ALL_STATS_DIR)
-                 if fnmatch.fnmatch(fname, "*all_to_all_stats_target_*.pkl")]
+                 if fnmatch.fnmatch(fname, "*all_to_all_stats_target*_*.pkl")]
     filenames = list(sorted(filenames, key=lambda fname: (len(fname), fname)))
     return filenames
 
@@ -42,7 +44,10 @@ def compute_observable_name_matrix(observable_name, limit=None):
         print(fname)
         with open(fname, 'rb') as f:
             data = pickle.load(f)
-            values.append(data['stats'][observable_name])
+        # a shard holds a list of per-target entries, the legacy format one entry
+        entries = data if isinstance(data, list) else [data]
+        for entry in entries:
+            values.append(entry['stats'][observable_name])
     return numpy.array(values)
 
 
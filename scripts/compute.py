@@ -1,12 +1,13 @@
 from __future__ import print_function
 
+import functools
+import multiprocessing
 import os
 import pickle
 
 import networkx
 import numpy
 import pandas
-import csv
 
 from gtfspy.routing.node_profile_analyzer_time_and_veh_legs import NodeProfileAnalyzerTimeAndVehLegs
 from gtfspy.routing.node_profile_multiobjective import NodeProfileMultiObjective
@@ -16,6 +17,20 @@ from gtfspy.routing.multi_objective_pseudo_connection_scan_profiler import Multi
 
 from settings import HELSINKI_DATA_BASEDIR, RESULTS_DIRECTORY, ROUTING_START_TIME_DEP, ROUTING_END_TIME_DEP, \
     ANALYSIS_START_TIME_DEP, HELSINKI_NODES_FNAME, ANALYSIS_END_TIME_DEP, HELSINKI_TRANSIT_CONNECTIONS_FNAME
+from util import run_in_parallel, split_into_equal_length_parts
+
+# The available summary measures are a static property of the analyzer class:
+# compute them once at import time (worker processes inherit them on fork)
+# instead of once per stats computation.
+_PROFILE_SUMMARY_METHODS, _PROFILE_OBSERVABLE_NAMES = \
+    NodeProfileAnalyzerTimeAndVehLegs.all_measures_and_names_as_lists()
+_OBSERVABLE_NAMES_AND_METHODS = list(zip(_PROFILE_OBSERVABLE_NAMES, _PROFILE_SUMMARY_METHODS))
+
+# Explicit pickle protocol for all caches (requires Python >= 3.8).
+# Note that without a buffer_callback the numpy array buffers are still
+# written in-band; pinning the protocol mainly keeps the cache files
+# readable across interpreter versions.
+_PICKLE_PROTOCOL = 5
 
 
 def target_list_to_str(targets):
@@ -32,33 +47,47 @@ def get_profile_data(targets=None, recompute=False, **kwargs):
     node_profiles_fname = os.path.join(RESULTS_DIRECTORY, "node_profile_" + target_list_to_str(targets) + ".pickle")
     if not recompute and os.path.exists(node_profiles_fname):
         print("Loading precomputed data")
-        profiles = pickle.load(open(node_profiles_fname, 'rb'))
+        with open(node_profiles_fname, 'rb', buffering=1 << 20) as f:
+            profiles = pickle.load(f)
         print(profiles)
         print("Loaded precomputed data")
     else:
         print("Recomputing profiles")
         profiles = _compute_profile_data(targets, return_profiler=False, **kwargs)
-        pickle.dump(profiles, open(node_profiles_fname, 'wb'), -1)
+        with open(node_profiles_fname, 'wb', buffering=1 << 20) as f:
+            pickle.dump(profiles, f, protocol=_PICKLE_PROTOCOL)
         print("Recomputing profiles")
     return profiles
 
 
-def get_node_profile_statistics(targets, recompute=False, recompute_profiles=False):
+def get_node_profile_statistics(targets, recompute=False, recompute_profiles=False, n_cpus=1):
     """
-    Get node profile statistics from pickle cache, or alternatively compute them based on (possibly) existing profiles.
+    Get node profile statistics from the .npz cache, or alternatively compute them based on (possibly) existing profiles.
+
+    n_cpus controls how many worker processes the per-stop stats computation
+    may use (see __compute_profile_stats_from_profiles).
     """
-    profile_statistics_fname = os.path.join(RESULTS_DIRECTORY, "node_profile_statistics_" +
-                                            target_list_to_str(targets) + ".pickle")
+    statistics_fname_base = os.path.join(RESULTS_DIRECTORY, "node_profile_statistics_" +
+                                         target_list_to_str(targets))
+    profile_statistics_fname = statistics_fname_base + ".npz"
+    legacy_pickle_fname = statistics_fname_base + ".pickle"
     if recompute_profiles:
         recompute = True
     if not recompute and os.path.exists(profile_statistics_fname):
         print("Loading precomputed statistics")
-        observable_name_to_data = pickle.load(open(profile_statistics_fname, 'rb'))
+        with numpy.load(profile_statistics_fname) as npz:
+            observable_name_to_data = dict(npz)
+        print("Loaded precomputed statistics")
+    elif not recompute and os.path.exists(legacy_pickle_fname):
+        # caches written before the .npz format
+        print("Loading precomputed statistics (legacy pickle)")
+        with open(legacy_pickle_fname, 'rb', buffering=1 << 20) as f:
+            observable_name_to_data = pickle.load(f)
         print("Loaded precomputed statistics")
     else:
         print("Recomputing statistics")
-        observable_name_to_data = _compute_node_profile_statistics(targets, recompute_profiles)
-        pickle.dump(observable_name_to_data, open(profile_statistics_fname, 'wb'), -1)
+        observable_name_to_data = _compute_node_profile_statistics(targets, recompute_profiles, n_cpus=n_cpus)
+        numpy.savez_compressed(profile_statistics_fname, **observable_name_to_data)
         print("Recomputed statistics")
     return observable_name_to_data
 
@@ -68,16 +97,31 @@ def read_connections_pandas(events_fname=HELSINKI_TRANSIT_CONNECTIONS_FNAME,
                             routing_end_time_dep=ROUTING_END_TIME_DEP):
     """
     Read events from a csv file, and create a list of Connection objects.
+
+    The columns are kept as plain numpy integer arrays (one array per column),
+    and the time filtering and sorting are done on the arrays; Connection
+    objects are materialized only once, in a single pass at the end.
     """
-    events = pandas.read_csv(events_fname)
-    events = events[events["dep_time_ut"] >= routing_start_time_dep]
-    time_filtered_events = events[events["dep_time_ut"] <= routing_end_time_dep]
-    time_filtered_events.sort_values("dep_time_ut", ascending=False, inplace=True)
-
-    connections = [
-        Connection(int(e.from_stop_I), int(e.to_stop_I), int(e.dep_time_ut), int(e.arr_time_ut), int(e.trip_I), int(e.seq))
-        for e in time_filtered_events.itertuples()
-        ]
+    columns = ["from_stop_I", "to_stop_I", "dep_time_ut", "arr_time_ut", "trip_I", "seq"]
+    # Read in chunks, keeping only the rows within the routing time window,
+    # so that peak memory stays at (filtered rows + one chunk) instead of the full file.
+    filtered_pieces = []
+    # int32 suffices for the stop/trip IDs and for unix times well past this
+    # dataset's window, and halves the memory traffic of the filter and sort.
+    for chunk in pandas.read_csv(events_fname, usecols=columns, dtype=numpy.int32,
+                                 engine='c', chunksize=10 ** 6):
+        dep_times = chunk["dep_time_ut"].values
+        mask = (dep_times >= routing_start_time_dep) & (dep_times <= routing_end_time_dep)
+        filtered_pieces.append([chunk[column].values[mask] for column in columns])
+    column_arrays = [numpy.concatenate([piece[j] for piece in filtered_pieces])
+                     for j in range(len(columns))]
+
+    dep_times = column_arrays[columns.index("dep_time_ut")]
+    # negate to sort by decreasing departure time
+    order = numpy.argsort(-dep_times, kind="stable")
+    column_lists = [column_array[order].tolist() for column_array in column_arrays]
+
+    connections = [Connection(*row) for row in zip(*column_lists)]
     return connections
 
 
@@ -86,59 +130,47 @@ def read_connections_csv(events_fname=HELSINKI_TRANSIT_CONNECTIONS_FNAME,
                          routing_end_time_dep=ROUTING_END_TIME_DEP):
     """
     Read events from a csv file, and create a list of Connection objects.
-    Uses the built-in
-    """
-    # header: from_stop_I, to_stop_I, dep_time_ut, arr_time_ut, route_type, trip_I, seq, route_I
-    from_node_index = 0
-    to_node_index = 1
-    dep_time_index = 2
-    arr_time_index = 3
-    trip_I_index = 5
-    seq_index = 6
-    connections = []
-    with open(events_fname, 'r') as csvfile:
-        events_reader = csv.reader(csvfile, delimiter=',')
-        for _row in events_reader:
-            break
-        for row in events_reader:
-            dep_time = int(row[dep_time_index])
-            if routing_start_time_dep <= dep_time <= routing_end_time_dep:
-                connections.append(
-                    Connection(int(row[from_node_index]), int(row[to_node_index]), int(row[dep_time_index]),
-                               int(row[arr_time_index]), int(row[trip_I_index]), int(row[seq_index])))
-    connections = sorted(connections, key=lambda conn: -conn.departure_time)
-    return connections
 
-
-def _read_transfers_pandas(max_walk_distance=1000):
-    import pandas
-    transfers = pandas.read_csv(HELSINKI_DATA_BASEDIR + "main.day.transfers.csv")
-    filtered_transfers = transfers[transfers["d_walk"] <= max_walk_distance]
-    net = networkx.Graph()
-    for row in filtered_transfers.itertuples():
-        net.add_edge(int(row.from_stop_I), int(row.to_stop_I), {"d_walk": row.d_walk})
-    return net
+    Kept for backwards compatibility: the row-by-row csv.reader loop has been
+    replaced by the vectorized pandas (C engine) reader, which parses and
+    filters the events outside the Python interpreter loop.
+    """
+    return read_connections_pandas(events_fname, routing_start_time_dep, routing_end_time_dep)
 
 
 def read_transfers_csv(fname=None, max_walk_distance=1000):
     # "from_stop_I,to_stop_I,d,d_walk"
-    from_node_index = 0
-    to_node_index = 1
-    d_walk_index = 3
-    net = networkx.Graph()
     if fname is None:
         fname = HELSINKI_DATA_BASEDIR + "main.day.transfers.csv"
-    with open(fname, 'r') as csv_file:
-        transfers_reader = csv.reader(csv_file, delimiter=',')
-        for _row in transfers_reader:
-            break
-        for row in transfers_reader:
-            d_walk = int(row[d_walk_index])
-            if d_walk <= max_walk_distance:
-                net.add_edge(int(row[from_node_index]), int(row[to_node_index]), {"d_walk": int(row[d_walk_index])})
+    transfers = pandas.read_csv(fname, usecols=["from_stop_I", "to_stop_I", "d_walk"],
+                                dtype=numpy.int32, engine='c')
+    within_walk_distance = transfers["d_walk"].values <= max_walk_distance
+    from_stops = transfers["from_stop_I"].values[within_walk_distance].tolist()
+    to_stops = transfers["to_stop_I"].values[within_walk_distance].tolist()
+    d_walks = transfers["d_walk"].values[within_walk_distance].tolist()
+    net = networkx.Graph()
+    net.add_edges_from(zip(from_stops, to_stops, ({"d_walk": d_walk} for d_walk in d_walks)))
     return net
 
 
+@functools.lru_cache(maxsize=None)
+def _read_connections_cached(events_fname, routing_start_time_dep, routing_end_time_dep):
+    """
+    Memoized version of read_connections_csv: repeated profiler constructions
+    with the same routing window share one parsed connection list. Safe, as the
+    profiler only iterates the list read-only.
+    """
+    return read_connections_csv(events_fname, routing_start_time_dep, routing_end_time_dep)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_transfers_cached(fname, max_walk_distance):
+    """
+    Memoized version of read_transfers_csv (see _read_connections_cached).
+    """
+    return read_transfers_csv(fname, max_walk_distance)
+
+
 def _get_new_csp_with_default_settings(targets=None, params=None, verbose=True):
     """
     Get a new MultiObjectivePseudoCSAProfiler with default settings and data for Helsinki.
@@ -160,7 +192,7 @@ def _get_new_csp_with_default_settings(targets=None, params=None, verbose=True):
     if "routing_end_time_dep" not in params or params["routing_end_time_dep"] is None:
         params['routing_end_time_dep'] = ROUTING_END_TIME_DEP
 
-    connections = read_connections_csv(
+    connections = _read_connections_cached(
         HELSINKI_TRANSIT_CONNECTIONS_FNAME,
         params["routing_start_time_dep"],
         params["routing_end_time_dep"]
@@ -171,7 +203,7 @@ def _get_new_csp_with_default_settings(targets=None, params=None, verbose=True):
     if "max_walk_distance" not in params:
         print("resetting max walk distance to default (1000m)")
         params["max_walk_distance"] = 1000
-    net = read_transfers_csv(None, params["max_walk_distance"])
+    net = _read_transfers_cached(None, params["max_walk_distance"])
     if "track_time" not in params:
         print("setting time tracking on")
         params["track_time"] = True
@@ -252,44 +284,95 @@ def _compute_profile_data(targets=[115], track_vehicle_legs=True, track_time=Tru
     return profiles
 
 
-def _compute_node_profile_statistics(targets, recompute_profiles=False):
+def _compute_node_profile_statistics(targets, recompute_profiles=False, n_cpus=1):
     profile_data = get_profile_data(targets, recompute=recompute_profiles)['profiles']
-    return __compute_profile_stats_from_profiles(profile_data)
+    return __compute_profile_stats_from_profiles(profile_data, n_cpus=n_cpus)
 
 
-def __compute_profile_stats_from_profiles(profile_data):
+def _stats_for_profiles(stop_Is_and_profiles):
     """
+    Compute all observable values for a sequence of profiles.
 
     Parameters
     ----------
-    profiles: dict
-        mapping from stop_I -> MultiObjectiveNodeProfile
+    stop_Is_and_profiles: list
+        (stop_I, profile) pairs, with profile None marking stops that
+        have no profile
 
     Returns
     -------
     observable_name_to_data: dict
+        mapping from observable name to a float64 array aligned with the pairs
     """
-    profile_summary_methods, profile_observable_names = NodeProfileAnalyzerTimeAndVehLegs.all_measures_and_names_as_lists()
-    profile_summary_data = [[] for _ in range(len(profile_observable_names))]
-
-    observable_name_to_method = dict(zip(profile_observable_names, profile_summary_methods))
-    observable_name_to_data = dict(zip(profile_observable_names, profile_summary_data))
-
-    nodes = pandas.read_csv(HELSINKI_NODES_FNAME, sep=";")
-    for stop_I in nodes['stop_I'].values:
-        try:
-            profile = profile_data[stop_I]
-        except KeyError:
-            profile = NodeProfileMultiObjective()
-            profile.finalize()
+    observable_names_and_methods = _OBSERVABLE_NAMES_AND_METHODS
+
+    # All stops without a profile share the same (empty) profile,
+    # so their observable values need to be computed only once.
+    empty_profile = NodeProfileMultiObjective()
+    empty_profile.finalize()
+    empty_profile_analyzer = NodeProfileAnalyzerTimeAndVehLegs(empty_profile,
+                                                               ANALYSIS_START_TIME_DEP, ANALYSIS_END_TIME_DEP)
+    empty_profile_values = {}
+    for observable_name, method in observable_names_and_methods:
+        value = method(empty_profile_analyzer)
+        empty_profile_values[observable_name] = numpy.nan if value is None else value
+
+    # One contiguous float64 array per observable, indexed by stop position,
+    # instead of growing a list of boxed floats per observable.
+    observable_name_to_data = dict((name, numpy.empty(len(stop_Is_and_profiles), dtype=numpy.float64))
+                                   for name in _PROFILE_OBSERVABLE_NAMES)
+    for i, (stop_I, profile) in enumerate(stop_Is_and_profiles):
+        if profile is None:
+            for observable_name, _method in observable_names_and_methods:
+                observable_name_to_data[observable_name][i] = empty_profile_values[observable_name]
+            continue
         profile_analyzer = NodeProfileAnalyzerTimeAndVehLegs(profile, ANALYSIS_START_TIME_DEP, ANALYSIS_END_TIME_DEP)
-        for observable_name in profile_observable_names:
-            method = observable_name_to_method[observable_name]
+        for observable_name, method in observable_names_and_methods:
             observable_value = method(profile_analyzer)
             if observable_value is None:
                 print(observable_name, stop_I)
-            _assert_results_are_positive_or_infs_or_nans(numpy.array([observable_value]))
-            observable_name_to_data[observable_name].append(observable_value)
+                observable_value = numpy.nan
+            observable_name_to_data[observable_name][i] = observable_value
+    return observable_name_to_data
+
+
+def __compute_profile_stats_from_profiles(profile_data, n_cpus=1):
+    """
+
+    Parameters
+    ----------
+    profile_data: dict
+        mapping from stop_I -> MultiObjectiveNodeProfile
+    n_cpus: int or "max"
+        number of worker processes for splitting the per-stop work
+        (keep at 1 when called from an already parallel context,
+        such as the all-to-all worker processes)
+
+    Returns
+    -------
+    observable_name_to_data: dict
+    """
+    nodes = pandas.read_csv(HELSINKI_NODES_FNAME, sep=";")
+    # plain Python ints as lookup keys: hashing a numpy scalar would box it
+    # to an int on every one of the N_stops dict lookups
+    stop_Is = nodes['stop_I'].values.tolist()
+    stop_Is_and_profiles = [(stop_I, profile_data.get(stop_I)) for stop_I in stop_Is]
+
+    if n_cpus == "max":
+        n_cpus = multiprocessing.cpu_count()
+    if n_cpus == 1:
+        observable_name_to_data = _stats_for_profiles(stop_Is_and_profiles)
+    else:
+        chunks = split_into_equal_length_parts(stop_Is_and_profiles, n_cpus)
+        chunk_results = run_in_parallel(_stats_for_profiles, chunks, n_cpus)
+        observable_name_to_data = dict(
+            (name, numpy.concatenate([chunk_result[name] for chunk_result in chunk_results]))
+            for name in _PROFILE_OBSERVABLE_NAMES
+        )
+
+    # One batched sanity check per observable instead of one per (stop, observable).
+    for observable_name in observable_name_to_data:
+        _assert_results_are_positive_or_infs_or_nans(observable_name_to_data[observable_name])
     return observable_name_to_data
 
 
@@ -309,32 +392,134 @@ def _assert_results_are_positive_or_infs_or_nans(array):
     AssertionError
         if some of the results results are not positive or infs or nans
     """
-    is_nan = numpy.isnan(array)
-    is_inf = numpy.isinf(array)
-    is_not_negative = (array >= 0)
-    assert (is_nan or is_inf or is_not_negative).all()
+    array = numpy.asarray(array, dtype=float)
+    # note: elementwise |, as Python's "or" would short-circuit on the first array
+    is_valid = numpy.isnan(array) | numpy.isinf(array) | (array >= 0)
+    assert is_valid.all()
+
+
+# Worker state for compute_all_to_all_profile_statistics_with_defaults:
+# the profiler (holding the connections and the walk network, tens of MB)
+# is constructed once per worker process and then reset for each target.
+_worker_csp = None
+_worker_verbose = False
+
+
+def _init_all_to_all_worker(verbose=False):
+    """
+    Initialize a worker process by constructing a profiler with default settings.
+    This loads the connection and walk network data once per worker, not once per target.
+    """
+    global _worker_csp, _worker_verbose
+    _worker_verbose = verbose
+    _worker_csp, _ = _get_new_csp_with_default_settings(targets=None, params={}, verbose=verbose)
+
+
+def _process_target(target_I):
+    """
+    Compute the profile statistics for a single target stop.
+
+    Work function for the process pool in compute_all_to_all_profile_statistics_with_defaults.
+    Requires that _init_all_to_all_worker has been run in this process.
+
+    Returns
+    -------
+    (target_I, to_store): tuple
+        to_store is None if the profile computation failed
+    """
+    global _worker_csp
+    try:
+        data, _worker_csp = _compute_profile_data([target_I], csp=_worker_csp,
+                                                  verbose=_worker_verbose, return_profiler=True)
+    except AssertionError:
+        return target_I, None
+    obs_name_to_data = __compute_profile_stats_from_profiles(data["profiles"])
+    to_store = {
+        "target": target_I,
+        "params": data["params"],
+        "stats": obs_name_to_data
+    }
+    return target_I, to_store
+
+
+# How many targets' results are batched into one shard file:
+# one file per target would mean thousands of tiny files, which is slow
+# on the cluster's network filesystem.
+_ALL_TO_ALL_SHARD_SIZE = 64
+
+
+def _write_all_to_all_shard(shard_targets, shard_entries):
+    """
+    Pickle the result dicts of one preassigned batch of targets into a single
+    shard file. The filename is derived from the batch's first and last
+    target, so a re-run overwrites its shards instead of writing new,
+    differently-named ones next to them.
+    """
+    fname = os.path.join(RESULTS_DIRECTORY, "all_to_all_stats",
+                         "all_to_all_stats_targets_{first}_{last}.pkl".format(
+                             first=shard_targets[0], last=shard_targets[-1]))
+    shard_entries = sorted(shard_entries, key=lambda entry: entry["target"])
+    with open(fname, "wb") as f:
+        pickle.dump(shard_entries, f, protocol=_PICKLE_PROTOCOL)
 
 
-def compute_all_to_all_profile_statistics_with_defaults(target_Is=None, verbose=False):
-    nodes = pandas.read_csv(HELSINKI_NODES_FNAME)
-    csp = None
+def compute_all_to_all_profile_statistics_with_defaults(target_Is=None, verbose=False, n_cpus=1, chunksize=4):
+    """
+    Compute and store profile statistics for each target stop.
+
+    Parameters
+    ----------
+    target_Is : list-like, optional
+        defaults to all stops
+    verbose : bool
+    n_cpus : int or "max"
+        number of worker processes ("max" uses all available cores)
+    chunksize : int
+        how many targets are handed to a worker at a time
+        (small values balance the load over the variable per-target runtimes)
+    """
     if target_Is is None:
+        nodes = pandas.read_csv(HELSINKI_NODES_FNAME)
         target_Is = nodes['stop_I']
-    for i, target_I in enumerate(target_Is):
+    target_Is = list(target_Is)
+    if n_cpus == "max":
+        n_cpus = multiprocessing.cpu_count()
+
+    # mainly for debugging purposes and generality
+    if n_cpus == 1:
+        pool = None
+        _init_all_to_all_worker(verbose)
+        results = (_process_target(target_I) for target_I in target_Is)
+    else:
+        pool = multiprocessing.Pool(processes=n_cpus,
+                                    initializer=_init_all_to_all_worker,
+                                    initargs=(verbose,))
+        results = pool.imap_unordered(_process_target, target_Is, chunksize=chunksize)
+
+    # Partition the targets into fixed ranges up front: each shard's contents
+    # and filename are then independent of the order in which the workers
+    # happen to finish, so requeued runs stay idempotent.
+    shards = [target_Is[j:j + _ALL_TO_ALL_SHARD_SIZE]
+              for j in range(0, len(target_Is), _ALL_TO_ALL_SHARD_SIZE)]
+    target_to_shard_index = {}
+    for shard_index, shard_targets in enumerate(shards):
+        for target_I in shard_targets:
+            target_to_shard_index[target_I] = shard_index
+    shard_entries = [[] for _shard_targets in shards]
+    shard_pending_counts = [len(shard_targets) for shard_targets in shards]
+
+    for i, (target_I, to_store) in enumerate(results):
         print(target_I, i, "/", len(target_Is))
-
-        try:
-            data, csp = _compute_profile_data([target_I], csp=csp, verbose=verbose, return_profiler=True)
-        except AssertionError as e:
-            continue
-
-        obs_name_to_data = __compute_profile_stats_from_profiles(data["profiles"])
-        fname = os.path.join(RESULTS_DIRECTORY, "all_to_all_stats",
-                             "all_to_all_stats_target_{target}.pkl".format(target=str(target_I)))
-        to_store = {
-            "target": target_I,
-            "params": data["params"],
-            "stats": obs_name_to_data
-        }
-        with open(fname, "wb") as f:
-            pickle.dump(to_store, f, -1)
\ No newline at end of file
+        shard_index = target_to_shard_index[target_I]
+        if to_store is not None:
+            shard_entries[shard_index].append(to_store)
+        shard_pending_counts[shard_index] -= 1
+        # write the shard (possibly empty, if all its targets failed)
+        # as soon as all of its targets are accounted for
+        if shard_pending_counts[shard_index] == 0:
+            _write_all_to_all_shard(shards[shard_index], shard_entries[shard_index])
+            shard_entries[shard_index] = []
+
+    if pool is not None:
+        pool.close()
+        pool.join()
\ No newline at end of file
@@ -1,5 +1,6 @@
 from __future__ import print_function
 
+import os
 import sys
 
 import pandas
@@ -11,16 +12,19 @@ from util import split_into_equal_length_parts
 
 
 if __name__ == "__main__":
-    _, slurm_array_i, slurm_array_length = sys.argv
-    slurm_array_i = int(slurm_array_i)
-    slurm_array_length = int(slurm_array_length)
+    slurm_array_i = int(sys.argv[1])
+    slurm_array_length = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        n_cpus = int(sys.argv[3])
+    else:
+        n_cpus = int(os.environ.get("SLURM_CPUS_PER_TASK", 1))
 
     assert(slurm_array_i < slurm_array_length)
     nodes = pandas.read_csv(HELSINKI_NODES_FNAME)['stop_I'].values
     parts = split_into_equal_length_parts(nodes, slurm_array_length)
     targets = parts[slurm_array_i]
 
-    compute_all_to_all_profile_statistics_with_defaults(targets)
+    compute_all_to_all_profile_statistics_with_defaults(targets, n_cpus=n_cpus)
 
 
 